@@ -1,9 +1,13 @@
-from picamera import PiCamera
 import time
 from datetime import datetime
 import os
+import io
 import logging
 import subprocess
+import signal
+import threading
+import queue
+import shutil
 import sys
 
 def initVideoSettings():
@@ -12,6 +16,8 @@ def initVideoSettings():
         'resolution': (1600,1200),
         'frameRate': 10,      # frame rate fps
         'quality': 20,        # 1 = best quality, 20 - ok, 30 poorer quality
+        'bitrate': 17000000,  # maximum bitrate in bits/s (picamera default)
+        'intraPeriod': None,  # frames between key frames, None: encoder default (key frames are full size: shorter periods give bigger files)
         'format': 'h264',     # 'h264', 'mjpeg'
         'exposure': 'night',  # 'auto', 'night','backlight'
         'AWB': 'auto',      # 'auto', 'cloudy', 'sunlight'
@@ -24,27 +30,198 @@ def initVideoSettings():
         }
     return videoSettings
 
-def captureVideo(outDir,iterFileName,videoSettings,flagname=''):
-    # Open iterator file for output filenames
-    curDir = os.getcwd()
-    iterFile = open(os.path.join(curDir,iterFileName),'r') 
+_FishCamCamera = None
+
+def fishCamCameraClass():
+    # picamera is only imported (and the camera class built) when a camera is
+    # first needed, so importing this script does not pay for it
+    global _FishCamCamera
+    if _FishCamCamera is None:
+        from picamera import PiCamera
+        from picamera.encoders import PiCookedVideoEncoder
+        from picamera.frames import PiVideoFrameType
+
+        class FishCamVideoEncoder(PiCookedVideoEncoder):
+            # Video encoder with output buffers sized from the bitrate instead of the
+            # MMAL recommended size (several MB per buffer at high resolutions)
+            def _create_encoder(self, format, **options):
+                super()._create_encoder(format, **options)
+                bitrate = options.get('bitrate', 17000000)
+                framerate = max(1, int(self.parent.framerate))
+                self.outputBufferSize = max(64*1024, (bitrate // 8) * 2 // framerate)
+
+            def start(self, output, motion_output=None):
+                self.pictureFrames = 0
+                # Set just before the port is enabled: connecting the encoder
+                # (in PiEncoder.__init__) resets the output buffer size
+                self.output_port.buffer_size = self.outputBufferSize
+                super().start(output, motion_output)
+                logging.info('Encoder output buffer size: ' + str(self.output_port.buffer_size) + ' bytes')
+
+            def _callback_write(self, buf, key=PiVideoFrameType.frame):
+                # Counts the pictures encoded. frame.index can't be used to detect
+                # dropped frames (it also counts the SPS headers).
+                result = super()._callback_write(buf, key)
+                if self.frame.complete and self.frame.frame_type not in (PiVideoFrameType.sps_header, PiVideoFrameType.motion_data):
+                    self.pictureFrames += 1
+                return result
+
+        class FishCamCamera(PiCamera):
+            def _get_video_encoder(self, camera_port, output_port, format, resize, **options):
+                if format in self.RAW_FORMATS:
+                    self.videoEncoder = None
+                    return super()._get_video_encoder(camera_port, output_port, format, resize, **options)
+                self.videoEncoder = FishCamVideoEncoder(self, camera_port, output_port, format, resize, **options)
+                return self.videoEncoder
+
+        _FishCamCamera = FishCamCamera
+    return _FishCamCamera
+
+def openVideoFile(videofilename,bufferSize=2*1024*1024):
+    # Large write buffer so the SD card gets few big writes instead of many
+    # small ones (small writes can starve the encoder buffers)
+    fh = io.open(videofilename,'wb',buffering=bufferSize)
+    if hasattr(os,'posix_fadvise'):
+        os.posix_fadvise(fh.fileno(),0,0,os.POSIX_FADV_SEQUENTIAL)
+    return fh
+
+def videoFileSuffix(videoSettings):
+    # End of the video file names (only depends on the video settings)
+    return '_%sx%s_awb-%s_exp-%s_fr-%s_q-%s_sh-%s_b-%s_c-%s_i-%s_sat-%s.%s' % (
+        videoSettings['resolution'][0], videoSettings['resolution'][1], videoSettings['AWB'],
+        videoSettings['exposure'], videoSettings['frameRate'], videoSettings['quality'],
+        videoSettings['sharpness'], videoSettings['brightness'], videoSettings['contrast'],
+        videoSettings['ISO'], videoSettings['saturation'], videoSettings['format'])
+
+def videoFileTemplate(videoSettings,flagname=''):
+    # Video file name with the {iter} and {ts} fields left to fill for each video
+    if len(flagname)>0:
+        flagname='_' + flagname
+    staticPart = lambda text: text.replace('{','{{').replace('}','}}')
+    return '{iter}' + staticPart(flagname) + '_{ts}' + staticPart(videoFileSuffix(videoSettings))
+
+def readIterNumber(iterFile):
+    # iterFile: iterator file opened in 'r+' mode
+    iterFile.seek(0)
     iterNumber = iterFile.read()
     if len(iterNumber) == 0:
-        iterNumber = 1
+        return 1
+    return int(iterNumber)
+
+def writeIterNumber(iterFile,iterNumber):
+    iterFile.seek(0)
+    iterFile.truncate()
+    iterFile.write(str(iterNumber))
+    iterFile.flush()
+    getattr(os,'fdatasync',os.fsync)(iterFile.fileno())
+
+def moveFile(tmpPath,dstPath):
+    try:
+        shutil.move(tmpPath,dstPath)
+        fd = os.open(dstPath,os.O_RDONLY)
+        os.fsync(fd)
+        os.close(fd)
+    except BaseException as e:
+        logging.error('Could not move ' + tmpPath + ': ' + str(e))
+
+def moveFiles(moveQueue):
+    # Moves files (tmpPath, dstPath) from the queue until None is received
+    while True:
+        item = moveQueue.get()
+        if item is None:
+            break
+        moveFile(*item)
+
+def sessionFolder(dataDir,iterNumber):
+    # Folder of the session a video belongs to: session folders are named after
+    # the iteration number of their first video
+    sessions = [int(entry.name) for entry in os.scandir(dataDir) if entry.name.isdigit() and entry.is_dir()]
+    sessions = [session for session in sessions if session <= iterNumber]
+    if len(sessions) == 0:
+        return dataDir
+    return os.path.join(dataDir,str(max(sessions)))
+
+def recoverVideoFiles(tmpDir,dataDir,videoSettings):
+    # Moves to their session folder in dataDir the videos left in tmpDir by a
+    # previous run that was stopped before they were moved (e.g. crash, or
+    # killed at shutdown)
+    videoExt = '.' + videoSettings['format']
+    for entry in sorted(os.scandir(tmpDir),key=lambda entry: entry.name):
+        if entry.name.endswith(videoExt) and entry.is_file():
+            prefix = entry.name.split('_')[0]
+            dstDir = sessionFolder(dataDir,int(prefix)) if prefix.isdigit() else dataDir
+            logging.warning('Recovering video left in ' + tmpDir + ': ' + entry.name + ' (moved to ' + dstDir + ')')
+            moveFile(entry.path,os.path.join(dstDir,entry.name))
+
+def stopFileMover(moveQueue,moverThread):
+    # Waits for the last videos to be moved
+    moveQueue.put(None)
+    moverThread.join()
+
+def startFileMover(maxQueued=2):
+    # Background thread moving videos recorded in tmpDir to the output folder.
+    # put() blocks when maxQueued videos are waiting (i.e. SD card too slow).
+    moveQueue = queue.Queue(maxsize=maxQueued)
+    moverThread = threading.Thread(target=moveFiles,args=(moveQueue,),daemon=True)
+    moverThread.start()
+    return moveQueue, moverThread
+
+def recordedFrames(camera):
+    # Number of pictures encoded since the recording started
+    encoder = getattr(camera,'videoEncoder',None)
+    if encoder is not None:
+        return encoder.pictureFrames
+    # raw formats (no headers): index of the last frame recorded
+    frame = camera.frame
+    if frame is None or frame.index is None:
+        return 0
+    return frame.index
+
+def waitRecording(camera,videoSettings,checkPeriod=0.5,minFrameRatio=0.7):
+    # Records for the video duration, in short waits (wait_recording also
+    # raises encoder errors) so frame drops can be reported while recording.
+    # Returns the number of frames recorded.
+    start = time.monotonic()
+    deadline = start + videoSettings['duration']
+    startFrame = recordedFrames(camera)
+    frames = 0
+    warned = False
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        camera.wait_recording(min(remaining,checkPeriod))
+        frames = recordedFrames(camera) - startFrame
+        elapsed = time.monotonic() - start
+        if not warned and elapsed > 2*checkPeriod and frames < minFrameRatio*elapsed*videoSettings['frameRate']:
+            logging.warning('Frames are being dropped: ' + str(frames) + ' frames recorded in ' + '%.1f' % elapsed + ' s')
+            warned = True
+    # Summary for this video
+    expectedFrames = int(round(videoSettings['duration']*videoSettings['frameRate']))
+    # a few extra frames are normal (sensor clock, wait_recording returning
+    # slightly after the deadline): up to 1 s of frames is tolerated
+    if frames > expectedFrames + videoSettings['frameRate']:
+        # more frames than the camera can produce: frames are miscounted
+        logging.warning('Frames recorded: %d/%d (more frames counted than expected)' % (frames,expectedFrames))
     else:
-        iterNumber = int(iterNumber)
-    iterFile.close()
-    # Get current time string for the file names
-    now = datetime.now()
-    timeStampStr = now.strftime("%Y%m%dT%H%M%S.%fZ")
-    if len(flagname)>0:
-        flagname='_' + flagname
-    videofilename = os.path.join(outDir,str(iterNumber) + flagname + '_' + timeStampStr + '_' + str(videoSettings['resolution'][0]) + 'x' + str(videoSettings['resolution'][1]) + '_awb-' + videoSettings['AWB'] + '_exp-' + videoSettings['exposure'] + '_fr-' + str(videoSettings['frameRate']) + '_q-' + str(videoSettings['quality']) + '_sh-' + str(videoSettings['sharpness']) + '_b-' + str(videoSettings['brightness']) + '_c-' + str(videoSettings['contrast']) + '_i-' + str(videoSettings['ISO']) + '_sat-' + str(videoSettings['saturation'])  + '.' + videoSettings['format'])
-    print(videofilename)
-    logging.info(videofilename)
-    
-    # Capture video
-    camera = PiCamera()
+        droppedFrames = max(0,expectedFrames - frames)
+        droppedPercent = 100.0*droppedFrames/expectedFrames if expectedFrames else 0.0
+        logging.info('Frames recorded: %d/%d (%d dropped, %.1f%%)' % (frames,expectedFrames,droppedFrames,droppedPercent))
+    return frames
+
+def recordingOptions(videoSettings):
+    # Encoder options for start_recording
+    options = {'format': videoSettings['format'],
+               'quality': videoSettings['quality'],
+               'bitrate': videoSettings['bitrate']}
+    if videoSettings['format'] == 'h264':
+        if videoSettings['intraPeriod'] is not None:
+            options['intra_period'] = videoSettings['intraPeriod']
+        options['sps_timing'] = True # frame rate written in the h264 headers
+    return options
+
+def initCamera(videoSettings):
+    camera = fishCamCameraClass()()
     camera.framerate = videoSettings['frameRate']
     camera.resolution = videoSettings['resolution']
     camera.exposure_mode = videoSettings['exposure']
@@ -54,41 +231,186 @@ def captureVideo(outDir,iterFileName,videoSettings,flagname=''):
     camera.contrast = videoSettings['contrast']
     camera.brightness = videoSettings['brightness']
     camera.saturation = videoSettings['saturation']
-    camera.iso = videoSettings['ISO']    
-    camera.start_recording(videofilename,format=videoSettings['format'], quality=videoSettings['quality'])
-    camera.wait_recording(videoSettings['duration'])
-    camera.stop_recording()
-    camera.close()    
-    # Updates iterator file
-    iterFile = open(os.path.join(curDir,iterFileName),'w') 
-    iterNumber += 1
-    iterFile.write(str(iterNumber)) 
-    iterFile.close()
+    camera.iso = videoSettings['ISO']
+    return camera
+
+def newVideoFile(outDir,iterNumber,videoSettings,flagname='',fileNameTemplate=None,tmpDir=None):
+    # Opens the next video file. Returns the file, the path it is recorded to
+    # and its final path in outDir.
+    if fileNameTemplate is None:
+        fileNameTemplate = videoFileTemplate(videoSettings,flagname)
+    # Get current time string for the file names
+    now = datetime.now()
+    timeStampStr = now.strftime("%Y%m%dT%H%M%S.%fZ")
+    videofilename = os.path.join(outDir,fileNameTemplate.format(iter=iterNumber,ts=timeStampStr))
+    print(videofilename)
+    logging.info(videofilename)
+    # Record in tmpDir (e.g. RAM) then move to outDir in the background
+    recordFilename = videofilename
+    if tmpDir is not None:
+        recordFilename = os.path.join(tmpDir,os.path.basename(videofilename))
+    return openVideoFile(recordFilename), recordFilename, videofilename
+
+def closeVideoFile(videoFile,recordFilename,videofilename,moveQueue=None):
+    try:
+        videoFile.close()
+    finally:
+        # moved even if the last data could not be written (e.g. SD card full)
+        if recordFilename != videofilename:
+            moveQueue.put((recordFilename,videofilename))
+
+def closeSplitVideo(videoFile,recordFilename,videofilename,moveQueue=None):
+    # Closes a file given to split_recording when the split did not complete.
+    # Returns True if the video is kept (the encoder switched to it).
+    videoFile.close()
+    if os.path.getsize(recordFilename) == 0:
+        os.remove(recordFilename)
+        return False
+    closeVideoFile(videoFile,recordFilename,videofilename,moveQueue=moveQueue)
+    return True
+
+def stopRecording(camera):
+    if camera.recording:
+        camera.stop_recording()
+
+def cleanupStep(errors,step,*args,**kwargs):
+    # Runs one step of a cleanup. Errors are logged and added to errors so the
+    # next steps still run. Returns the step result (None on error).
+    try:
+        return step(*args,**kwargs)
+    except BaseException as e:
+        logging.error('Error in ' + step.__name__ + ': ' + str(e))
+        errors.append(e)
+
+def raiseCleanupError(errors):
+    # Raises the first cleanup error, unless the cleanup is done because of
+    # another exception (which is then the one raised)
+    if len(errors) > 0 and sys.exc_info()[0] is None:
+        raise errors[0]
+
+def captureVideo(outDir,iterFile,videoSettings,flagname='',camera=None):
+    # Records a single video (with the camera provided, if any) and updates
+    # the iterator file (opened in 'r+' mode). Returns the new iteration number.
+    iterNumber = readIterNumber(iterFile)
+    closeCamera = camera is None
+    if closeCamera:
+        camera = initCamera(videoSettings)
+    video = None
+    try:
+        video = newVideoFile(outDir,iterNumber,videoSettings,flagname=flagname)
+        camera.start_recording(video[0],**recordingOptions(videoSettings))
+        waitRecording(camera,videoSettings)
+        camera.stop_recording()
+    finally:
+        # also reached on SIGTERM/Ctrl-C so the encoder is flushed to the file.
+        # Each step runs even if the previous ones failed.
+        errors = []
+        cleanupStep(errors,stopRecording,camera)
+        if closeCamera:
+            cleanupStep(errors,camera.close)
+        if video is not None:
+            cleanupStep(errors,closeVideoFile,*video)
+            iterNumber += 1
+            cleanupStep(errors,writeIterNumber,iterFile,iterNumber)
+        raiseCleanupError(errors)
+    return iterNumber
 
-def isCameraOperational():
+def checkGPUMemory(minGPUMem=256):
+    # The h264 encoding is done by the GPU (VideoCore). Too little GPU memory
+    # (gpu_mem in /boot/config.txt) leads to "buffer is starving" errors.
     try:
-        camera = PiCamera()
+        out = subprocess.check_output(['vcgencmd', 'get_mem', 'gpu']).decode() # e.g. gpu=128M
+        gpuMem = int(out.strip().split('=')[1].rstrip('M'))
+        if gpuMem < minGPUMem:
+            logging.warning('GPU memory is ' + str(gpuMem) + 'M. Set gpu_mem=' + str(minGPUMem) + ' in /boot/config.txt')
+        return gpuMem
+    except Exception as e: # not BaseException: SIGTERM (SystemExit) must stop the script
+        logging.error('Could not check GPU memory: ' + str(e))
+        return None
+
+def isCameraOperational(camera=None):
+    if camera is not None: # camera already opened
+        return not camera.closed
+    try:
+        camera = fishCamCameraClass()()
         camera.close()
         return True
     except BaseException as e:
         logging.error(str(e))
         return False
 
-def captureVideo_loop(outDir,iterFileName,iterations=0, videoSettings=0,flagname=''):  
+def captureVideo_loop(outDir,iterFile,iterations=0, videoSettings=0,flagname='',iterFlushPeriod=10,tmpDir=None,iterNumber=None,camera=None):  
+    # iterFile: iterator file opened in 'r+' mode. iterNumber: current
+    # iteration number if already read from iterFile. camera: camera already
+    # opened with initCamera(videoSettings) (left open at the end).
     # Load default settings if nothing else provided
     if videoSettings == 0:
         videoSettings = initVideoSettings()   
-    # Loop
-    if iterations == 0:  # Indefinite loop if no iterations provided
-        loop= True
-        while loop:
-            captureVideo(outDir,iterFileName,videoSettings,flagname=flagname)
-    elif iterations > 0:  # Finite loop if iterations provided
-        for it in range(iterations):
-            captureVideo(outDir,iterFileName,videoSettings,flagname=flagname)
+    fileNameTemplate = videoFileTemplate(videoSettings,flagname)
+    # Iterator is kept in memory and only saved every iterFlushPeriod videos
+    # (and when the loop stops)
+    if iterNumber is None:
+        iterNumber = readIterNumber(iterFile)
+    # Camera is opened and configured once for all the videos of the loop
+    closeCamera = camera is None
+    if closeCamera:
+        camera = initCamera(videoSettings)
+    moveQueue = None
+    if tmpDir is not None:
+        moveQueue, moverThread = startFileMover()
+    # Loop (indefinite loop if no iterations provided). The recording runs
+    # for the whole loop and is split into a new file for each video.
+    it = 0
+    video = None
+    videoCounted = False # iterNumber already incremented for the current video
+    splitVideo = None
+    try:
+        while iterations == 0 or it < iterations:
+            nextVideo = newVideoFile(outDir,iterNumber,videoSettings,fileNameTemplate=fileNameTemplate,tmpDir=tmpDir)
+            if video is None:
+                video = nextVideo
+                videoCounted = False
+                camera.start_recording(video[0],**recordingOptions(videoSettings))
+            else:
+                # until the split is done, nextVideo is closed on errors (e.g.
+                # split timed out, or SIGTERM) in the finally block below
+                splitVideo = nextVideo
+                camera.split_recording(nextVideo[0]) # switches file at the next key frame (no gap)
+                splitVideo = None
+                previousVideo, video = video, nextVideo
+                videoCounted = False
+                closeVideoFile(*previousVideo,moveQueue=moveQueue)
+            waitRecording(camera,videoSettings)
+            iterNumber += 1
+            videoCounted = True
+            it += 1
+            if it % iterFlushPeriod == 0:
+                writeIterNumber(iterFile,iterNumber)
+    finally:
+        # also reached on SIGTERM/Ctrl-C so the encoder is flushed to the file.
+        # Each step runs even if the previous ones failed, so the iterator is
+        # always saved and the last videos moved.
+        errors = []
+        cleanupStep(errors,stopRecording,camera)
+        if closeCamera:
+            cleanupStep(errors,camera.close)
+        if video is not None:
+            cleanupStep(errors,closeVideoFile,*video,moveQueue=moveQueue)
+            if not videoCounted: # interrupted video is kept: its number is used
+                iterNumber += 1
+        if splitVideo is not None:
+            # the encoder may have switched to it before being stopped
+            if cleanupStep(errors,closeSplitVideo,*splitVideo,moveQueue=moveQueue) is not False:
+                iterNumber += 1 # kept (or unknown): its number is used
+        cleanupStep(errors,writeIterNumber,iterFile,iterNumber)
+        if moveQueue is not None:
+            cleanupStep(errors,stopFileMover,moveQueue,moverThread)
+        raiseCleanupError(errors)
+    return iterNumber
 
 
-def captureVideo_test(outDir,iterFileName,duration=10,flagname=''):    
+def captureVideo_test(outDir,iterFilePath,duration=10,flagname=''):    
+    iterFile = open(iterFilePath,'r+')
     
     # Test brightness
     videoSettings = initVideoSettings()   
@@ -96,7 +418,7 @@ def captureVideo_test(outDir,iterFileName,duration=10,flagname=''):
     paramVals = range(40,105,5)
     for param in paramVals:        
         videoSettings['brightness'] = param
-        captureVideo_loop(outDir,iterFileName,iterations=1,videoSettings=videoSettings,flagname=flagname)     
+        captureVideo(outDir,iterFile,videoSettings,flagname=flagname)     
     
     # Test contrast
     videoSettings = initVideoSettings()   
@@ -104,7 +426,7 @@ def captureVideo_test(outDir,iterFileName,duration=10,flagname=''):
     paramVals = range(-20,120,20)        
     for param in paramVals:        
         videoSettings['contrast'] = param
-        captureVideo_loop(outDir,iterFileName,iterations=1,videoSettings=videoSettings,flagname=flagname)
+        captureVideo(outDir,iterFile,videoSettings,flagname=flagname)
     
     # Test saturation
     videoSettings = initVideoSettings()   
@@ -112,7 +434,7 @@ def captureVideo_test(outDir,iterFileName,duration=10,flagname=''):
     paramVals = range(-100,120,20)        
     for param in paramVals:        
         videoSettings['saturation'] = param
-        captureVideo_loop(outDir,iterFileName,iterations=1,videoSettings=videoSettings,flagname=flagname)
+        captureVideo(outDir,iterFile,videoSettings,flagname=flagname)
         
     # Test sharpness
     videoSettings = initVideoSettings()   
@@ -120,7 +442,7 @@ def captureVideo_test(outDir,iterFileName,duration=10,flagname=''):
     paramVals = range(-100,120,20)        
     for param in paramVals:        
         videoSettings['sharpness'] = param
-        captureVideo_loop(outDir,iterFileName,iterations=1,videoSettings=videoSettings,flagname=flagname)
+        captureVideo(outDir,iterFile,videoSettings,flagname=flagname)
 
     # Test ISO
     videoSettings = initVideoSettings()   
@@ -128,7 +450,7 @@ def captureVideo_test(outDir,iterFileName,duration=10,flagname=''):
     paramVals = [100,200,320,400,500,640,800]    
     for param in paramVals:        
         videoSettings['ISO'] = param
-        captureVideo_loop(outDir,iterFileName,iterations=1, videoSettings=videoSettings,flagname=flagname) 
+        captureVideo(outDir,iterFile,videoSettings,flagname=flagname) 
 
     # Test exposure
     videoSettings = initVideoSettings()   
@@ -136,16 +458,43 @@ def captureVideo_test(outDir,iterFileName,duration=10,flagname=''):
     paramVals = ['auto', 'night','backlight']    
     for param in paramVals:        
         videoSettings['exposure'] = param
-        captureVideo_loop(outDir,iterFileName,iterations=1,videoSettings=videoSettings,flagname=flagname) 
+        captureVideo(outDir,iterFile,videoSettings,flagname=flagname) 
     # Test AWB
     videoSettings = initVideoSettings()   
     videoSettings['duration'] = duration    
     paramVals = ['auto', 'cloudy', 'sunlight']    
     for param in paramVals:        
         videoSettings['AWB'] = param
-        captureVideo_loop(outDir,iterFileName,iterations=1,videoSettings=videoSettings,flagname=flagname) 
+        captureVideo(outDir,iterFile,videoSettings,flagname=flagname) 
+    iterFile.close()
 
 
+def ringBuzzer():
+    try:
+        import runBuzzer
+        runBuzzer.ringBuzzer()
+    except BaseException as e:
+        logging.error('Buzzer error: ' + str(e))
+
+def startBuzzer():
+    # Rings the buzzer in a background thread (no new python process)
+    buzzerThread = threading.Thread(target=ringBuzzer, daemon=True)
+    buzzerThread.start()
+    return buzzerThread
+
+def stopBuzzer(buzzerThread):
+    # Turns the buzzer OFF before exiting (the daemon thread would be killed
+    # with the buzzer pin possibly left ON)
+    try:
+        import runBuzzer
+        runBuzzer.stopBuzzer(buzzerThread)
+    except Exception as e:
+        logging.error('Buzzer error: ' + str(e))
+
+def stopOnSignal(signum, frame):
+    # Turns SIGTERM (e.g. shutdown) into an exception so recordings are closed cleanly
+    raise SystemExit('Signal ' + str(signum) + ' received')
+
 def main():
     # Parameters 
     outDir=r'../data'
@@ -154,27 +503,40 @@ def main():
     FishCamIDFileName = r'FishCamID.config'
     BuzzerEnabled = True
     BuzzerIterationPeriod = -1
+    iterFlushPeriod = 10 # number of videos between two saves of the iterator file
+    tmpDir = None # e.g. '/dev/shm' to record in RAM and move videos to outDir in the background (needs RAM for ~3 videos)
     
+    # Stop cleanly on shutdown
+    signal.signal(signal.SIGTERM, stopOnSignal)
+
     # Start logs
-    if os.path.isdir(logDir) == False:
-        os.mkdir(logDir)
+    os.makedirs(logDir,exist_ok=True)
     logging.basicConfig(filename=os.path.join(logDir,time.strftime('%Y%m%dT%H%M%S') +'.log'), level=logging.DEBUG,format='%(asctime)s %(levelname)s %(name)s %(message)s')
     logging.info('Video acquisition started')
-    if os.path.isdir(outDir) == False:
-        os.mkdir(outDir)
+    checkGPUMemory()
+    os.makedirs(outDir,exist_ok=True)
+    camera = None
+    buzzerThread = None
     try: 
         curDir = os.getcwd() # get current working directory
+        iterFilePath = os.path.join(curDir,iterFileName)
         # Get FishCam ID
         FishCamIDFile = open(os.path.join(curDir,FishCamIDFileName),'r') # Open FishCam ID file for output filenames
         FishCamID = FishCamIDFile.read()        
-        # get iteration number
-        iterFile = open(os.path.join(curDir,iterFileName),'r') # Open iterator file for output filenames
-        iterNumber = iterFile.read()
+        # get iteration number (iterator file is kept open and passed to the capture loop)
+        iterFile = open(iterFilePath,'r+') # Open iterator file for output filenames
+        iterNumber = readIterNumber(iterFile)
+        videoSettings = initVideoSettings() # default settings
+        # Videos of the previous session not moved from tmpDir (before the new
+        # session folder is created)
+        if tmpDir is not None:
+            recoverVideoFiles(tmpDir,outDir,videoSettings)
         # Creates output folder for this session based on the iteration number            
-        subFolderName = iterNumber
+        subFolderName = str(iterNumber)
         outDir = os.path.join(outDir,subFolderName)
-        if os.path.isdir(outDir) == False:
-            os.mkdir(outDir)
+        os.makedirs(outDir,exist_ok=True)
+        # Opens the camera once for both the buzzer check and the video capture
+        camera = initCamera(videoSettings)
         
         # Infinite loop
         BuzzerIdx=0
@@ -182,7 +544,7 @@ def main():
             
             # Ring buzzer            
             if BuzzerIdx == 0 and BuzzerEnabled:
-                camOK = isCameraOperational() # checks that camera is working
+                camOK = isCameraOperational(camera) # checks that camera is working
                 #print(camOK)
                 
                 ## DEBUG ##
@@ -193,11 +555,11 @@ def main():
                 
                 if camOK == True: # rings the buzzer only if camera is confirmed to be working (needed for pre-deploymnet verification)
                     logging.info('Buzzer turned ON')                    
-                    pid = subprocess.Popen([sys.executable, 'runBuzzer.py'])
+                    buzzerThread = startBuzzer()
                     
                     
             # Capture video            
-            captureVideo_loop(outDir,iterFileName,iterations=0,flagname=FishCamID)  # default settings
+            iterNumber = captureVideo_loop(outDir,iterFile,iterations=0,videoSettings=videoSettings,flagname=FishCamID,iterFlushPeriod=iterFlushPeriod,tmpDir=tmpDir,iterNumber=iterNumber,camera=camera)
             
             ## DEBUG
             #import datetime
@@ -217,6 +579,12 @@ def main():
             
     except BaseException as e:
         logging.error(str(e))
+    finally:
+        errors = []
+        if camera is not None:
+            cleanupStep(errors,camera.close)
+        if buzzerThread is not None:
+            cleanupStep(errors,stopBuzzer,buzzerThread)
 
 if __name__ == '__main__':   
     main()
\ No newline at end of file
@@ -5,8 +5,10 @@ Created on Tue Oct 23 10:12:57 2018
 @author: xavier.mouy
 """
 import os
-import fnmatch
+import shutil
 import subprocess
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 ##############################################################################
 ##############################################################################
@@ -23,20 +25,56 @@ indir = r".\data" # main directory where the h264 files are (it will go through
 outdir= r'.\mp4' # folder where the mp4 files will be saved
 video_fps = 20 # Frame per second
 video_ext = "*.h264"
+concatenate = False # True: one mp4 per folder (h264 files of the folder joined in iteration order, one MP4Box call per folder)
+# MP4Box executable (found on the PATH, otherwise default Windows install folder)
+mp4box_path = shutil.which("MP4Box") or shutil.which("mp4box") or r"C:\Program Files\GPAC\mp4box.exe"
 
 ##############################################################################
 ##############################################################################
 
+## Wrap h264 file(s) as one mp4 ############################################
+def run_mp4box(job):
+    fnames, outname = job
+    if not concatenate:
+        cmd = [mp4box_path, "-fps", str(video_fps), "-add", fnames[0], outname]
+    else: # concatenation of the h264 files of a folder (even a single one)
+        cmd = [mp4box_path, "-fps", str(video_fps), "-add", fnames[0]]
+        for fname in fnames[1:]:
+            cmd += ["-cat", fname]
+        cmd += ["-new", outname]
+    result = subprocess.run(cmd, stdout=subprocess.DEVNULL)
+    return fnames[0], result.returncode
+
+## Order of the videos in a folder ##########################################
+def iteration_key(h264):
+    # FishCam file names start with the iteration number (<iter>_<ID>_<time>...):
+    # sorted as numbers so that e.g. 98, 99 come before 100
+    prefix = h264.name.split('_')[0]
+    return (0, int(prefix), h264.name) if prefix.isdigit() else (1, 0, h264.name)
+
+## Name of the mp4 joining the videos of a folder ############################
+def folder_mp4_name(folder):
+    # Path of the folder relative to indir (e.g. FishCam01_12.mp4) so that
+    # sessions with the same number from different FishCams don't collide
+    parts = folder.relative_to(indir).parts or (Path(indir).resolve().name,)
+    return '_'.join(parts) + '.mp4'
+
 ## Loop through h264 files ################################################### 
-for root, directories, filenames in os.walk(indir):
-    directories.sort()
-    for filename in sorted(filenames):        
-        if fnmatch.fnmatch(filename, video_ext):            
-            fname = os.path.join(root,filename)
-            filerootname = os.path.splitext(os.path.basename(fname))[0]
-            print(' ')
-            print('--------------------------------------------') 
-            print (fname)      
-            #subprocess.call(["C:\Program Files\GPAC\mp4box.exe", "-fps", str(video_fps), "-add", os.path.join(indir,infile), os.path.join(outdir,filerootname + '.mp4')])
-            subprocess.call(["C:\Program Files\GPAC\mp4box.exe", "-fps", str(video_fps), "-add", fname, os.path.join(outdir,filerootname + '.mp4')])
-        
\ No newline at end of file
+h264_files = sorted(Path(indir).rglob(video_ext))
+if concatenate:
+    folders = {}
+    for h264 in h264_files:
+        folders.setdefault(h264.parent, []).append(h264)
+    jobs = [([str(h264) for h264 in sorted(h264s, key=iteration_key)], str(Path(outdir) / folder_mp4_name(folder)))
+            for folder, h264s in folders.items()]
+else:
+    jobs = [([str(h264)], str(Path(outdir) / (h264.stem + '.mp4'))) for h264 in h264_files]
+
+# MP4Box runs one file per process: several processes are run in parallel
+with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+    for fname, returncode in executor.map(run_mp4box, jobs):
+        print(' ')
+        print('--------------------------------------------') 
+        print (fname)
+        if returncode != 0:
+            print('MP4Box failed with exit code ' + str(returncode))
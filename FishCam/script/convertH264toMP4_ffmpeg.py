@@ -6,8 +6,8 @@ Created on Thu Nov 10 13:38:15 2022
 """
 
 import os
-import fnmatch
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 
 ##############################################################################
 ##############################################################################
@@ -22,31 +22,63 @@ ffmpeg_path = r"C:\Users\xavier.mouy\Documents\Software\ffmpeg\bin\ffmpeg.exe"
 indir = r"C:\Users\xavier.mouy\Documents\Projects\2022_DFO_fish_catalog\videos_Darienne\test h264"  # main directory where the h264 files are (it will go through all subfolders)
 outdir = r"C:\Users\xavier.mouy\Documents\Projects\2022_DFO_fish_catalog\videos_Darienne\mp4"  # folder where the mp4 files will be saved
 video_fps = 10  # Frame per second
-video_ext = "*.h264"
+video_ext = ".h264"
 
 ##############################################################################
 ##############################################################################
 
+## Find h264 files (recursively, sorted by name) ###########################
+def _walk_h264(root):
+    # DirEntry caches the file type so no extra stat() is needed per entry
+    subdirs = []
+    files = []
+    try:
+        with os.scandir(root) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif entry.name.lower().endswith(video_ext) and entry.is_file():
+                    files.append(entry.path)
+    except OSError:
+        # unreadable folder: skipped (as os.walk does)
+        return
+    yield from sorted(files)
+    for subdir in sorted(subdirs):
+        yield from _walk_h264(subdir)
+
+
+## Remux one h264 file ######################################################
+def convert_file(fname):
+    filerootname = os.path.splitext(os.path.basename(fname))[0]
+    # Stream copy: the h264 elementary stream is wrapped in the mp4 container
+    # as is (no decoding/re-encoding, no quality loss).
+    cmd_string = [
+        ffmpeg_path,
+        "-hide_banner",
+        "-loglevel",
+        "error",
+        "-nostdin",
+        "-y",
+        "-framerate",
+        str(video_fps),
+        "-i",
+        fname,
+        "-c:v",
+        "copy",
+        os.path.join(outdir, filerootname + ".mp4"),
+    ]
+    result = subprocess.run(cmd_string, stdout=subprocess.DEVNULL)
+    return fname, result.returncode
+
+
 ## Loop through h264 files ###################################################
-for root, directories, filenames in os.walk(indir):
-    directories.sort()
-    for filename in sorted(filenames):
-        if fnmatch.fnmatch(filename, video_ext):
-            fname = os.path.join(root, filename)
-            filerootname = os.path.splitext(os.path.basename(fname))[0]
-            print(" ")
-            print("--------------------------------------------")
-            print(fname)
-            # This is the code that works in the terminal window for conversion: NAME OF WORKING DIRECTORY HERE>ffmpeg -framerate 10 -i test.h264 test2.mp4
-            cmd_string = [
-                ffmpeg_path,
-                "-framerate",
-                str(video_fps),
-                "-i",
-                fname,
-                os.path.join(outdir, filerootname + ".mp4"),
-            ]
-            result = subprocess.run(
-                cmd_string, stdout=subprocess.PIPE, text=True
-            )
-            print(result.stdout)
+h264_files = _walk_h264(indir)
+
+# Remuxing is I/O bound so files are processed in parallel threads
+with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+    for fname, returncode in executor.map(convert_file, h264_files):
+        print(" ")
+        print("--------------------------------------------")
+        print(fname)
+        if returncode != 0:
+            print("ffmpeg failed with exit code " + str(returncode))
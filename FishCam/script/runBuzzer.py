@@ -1,5 +1,10 @@
 import RPi.GPIO as GPIO
 import time
+import threading
+try:
+    import pigpio # hardware timed beeps (needs the pigpiod daemon running)
+except ImportError:
+    pigpio = None
 
 # input parameters
 buzzer_pin = 26
@@ -9,23 +14,114 @@ beep_number = 10
 number_beep_sequences = 5
 gap_btw_sequences_sec = 5
 
+# GPIO is set up only once per process; the lock also serializes concurrent rings
+_gpio_lock = threading.RLock()
+_gpio_pins = set()
+# set by stopBuzzer() to end a ring running in another thread
+_stop_ringing = threading.Event()
+
+def setupGPIO(buzzer_pin):
+    with _gpio_lock:
+        if buzzer_pin not in _gpio_pins:
+            GPIO.setwarnings(False) 
+            GPIO.setmode(GPIO.BCM) # Broadcom chip-specific pin numbers.(different than the Board numbering scheme)
+            GPIO.setup(buzzer_pin, GPIO.OUT) # defines the buzzer pin as an "output" pin
+            _gpio_pins.add(buzzer_pin)
+
+def sleepUntil(deadline):
+    # Sleeps until an absolute time.monotonic() deadline, so delays don't accumulate
+    # (returns early when stopBuzzer() is called)
+    remaining = deadline - time.monotonic()
+    if remaining > 0:
+        _stop_ringing.wait(remaining)
+
 def playBeepSequence(buzzer_pin,beep_dur_sec,beep_gap_sec,beep_number):
+    t0 = time.monotonic()
     for n in range(0,beep_number):
+        beep_start = t0 + n*(beep_dur_sec+beep_gap_sec)
+        sleepUntil(beep_start)
+        if _stop_ringing.is_set():
+            break
         # Turn buzzer ON for the time period defined
         GPIO.output(buzzer_pin, True) # turn ON
-        time.sleep(beep_dur_sec) # duration of each beep
+        sleepUntil(beep_start+beep_dur_sec) # duration of each beep
         GPIO.output(buzzer_pin, False)# turn OFF
-        time.sleep(beep_gap_sec) # dution between beeps (silence)
+    sleepUntil(t0 + beep_number*(beep_dur_sec+beep_gap_sec)) # dution between beeps (silence)
+
+def connectPigpio():
+    # Returns a connection to the pigpio daemon, or None if not available
+    if pigpio is None:
+        return None
+    pi = pigpio.pi()
+    if not pi.connected:
+        return None
+    return pi
+
+def createBeepWave(pi,buzzer_pin,beep_dur_sec,beep_gap_sec,beep_number):
+    # One beep sequence as a pigpio waveform: GPIO transitions are timed by DMA
+    # (microsecond precision) instead of time.sleep
+    pulses = []
+    for n in range(0,beep_number):
+        pulses.append(pigpio.pulse(1<<buzzer_pin, 0, int(beep_dur_sec*1e6))) # ON
+        pulses.append(pigpio.pulse(0, 1<<buzzer_pin, int(beep_gap_sec*1e6))) # OFF
+    pi.set_mode(buzzer_pin, pigpio.OUTPUT)
+    pi.wave_clear()
+    pi.wave_add_generic(pulses)
+    return pi.wave_create()
+
+def playBeepWave(pi,wave_id):
+    pi.wave_send_once(wave_id)
+    while pi.wave_tx_busy():
+        if _stop_ringing.wait(0.05):
+            pi.wave_tx_stop()
+            break
 
-# Setting up GPIO
-GPIO.setwarnings(False) 
-GPIO.setmode(GPIO.BCM) # Broadcom chip-specific pin numbers.(different than the Board numbering scheme)
-GPIO.setup(buzzer_pin, GPIO.OUT) # defines the buzzer pin as an "output" pin
+def ringBuzzer(buzzer_pin=buzzer_pin,beep_dur_sec=beep_dur_sec,beep_gap_sec=beep_gap_sec,beep_number=beep_number,number_beep_sequences=number_beep_sequences,gap_btw_sequences_sec=gap_btw_sequences_sec):
+    # Can be called from a thread of another script (e.g. captureVideo.py)
+    # Each beep sequence starts at a fixed period from the first one
+    seq_period = beep_number*(beep_dur_sec+beep_gap_sec) + gap_btw_sequences_sec
+    with _gpio_lock:
+        pi = connectPigpio()
+        if pi is not None:
+            try:
+                wave_id = createBeepWave(pi,buzzer_pin,beep_dur_sec,beep_gap_sec,beep_number)
+                t0 = time.monotonic()
+                for seq in range(0,number_beep_sequences):
+                    sleepUntil(t0 + seq*seq_period)
+                    if _stop_ringing.is_set():
+                        break
+                    playBeepWave(pi,wave_id)
+                sleepUntil(t0 + number_beep_sequences*seq_period)
+                pi.wave_delete(wave_id)
+            finally:
+                pi.write(buzzer_pin, 0) # OFF (also if stopped in the middle of a beep)
+                pi.stop()
+            return
+        # Fallback: beeps timed in python with RPi.GPIO
+        setupGPIO(buzzer_pin)
+        # Play beep sequences
+        t0 = time.monotonic()
+        for seq in range(0,number_beep_sequences):
+            sleepUntil(t0 + seq*seq_period)
+            if _stop_ringing.is_set():
+                break
+            playBeepSequence(buzzer_pin,beep_dur_sec,beep_gap_sec,beep_number)
+        sleepUntil(t0 + number_beep_sequences*seq_period)
 
-# Play beep sequences
-for seq in range(0,number_beep_sequences):
-    playBeepSequence(buzzer_pin,beep_dur_sec,beep_gap_sec,beep_number)
-    time.sleep(gap_btw_sequences_sec) 
+def stopBuzzer(buzzerThread=None,timeout=2):
+    # Stops a ring running in buzzerThread (for the rest of the process), turns
+    # the buzzer OFF and releases the GPIO. Called before the calling script exits
+    # so the buzzer is not left ON.
+    _stop_ringing.set()
+    if buzzerThread is not None:
+        buzzerThread.join(timeout)
+    for buzzer_pin in _gpio_pins:
+        GPIO.output(buzzer_pin, False)
+    if _gpio_pins:
+        GPIO.cleanup()
+        _gpio_pins.clear()
 
-# Close all open ports
-GPIO.cleanup()
\ No newline at end of file
+if __name__ == '__main__':
+    ringBuzzer()
+    # Close all open ports
+    GPIO.cleanup()